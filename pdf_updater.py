@@ -1,17 +1,21 @@
+from concurrent.futures import ProcessPoolExecutor
 import csv
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import lru_cache
 import glob
-import pathlib
-import re
+from itertools import repeat
 import sys
 import os
+from types import MappingProxyType
 
 from pypdf import PdfReader
 from pypdf import PdfWriter
 from pypdf.errors import EmptyFileError
 
 
-RE_OFFSET = re.compile("([+-])(\d{2})'(\d{2})'$")
+CSV_READ_BUFFER_SIZE = 512 * 1024
 
 # https://forscore.co/developers-pdf-metadata/
 
@@ -28,7 +32,6 @@ META_MAP = {
     '/Keywords': 'Tags',
     '/rating': 'Rating',
     '/difficulty': 'Difficulty',
-    '/rating': 'Rating',
     '/duration': 'Duration',
     # Note: These don't match directly to a single input. Their presence here
     #       is primarily informational.
@@ -36,7 +39,7 @@ META_MAP = {
     '/keysmi': 'Key',
 }
 
-REV_META_MAP = dict((v, k) for (k, v) in META_MAP.items())
+REV_META_MAP = MappingProxyType({v: k for (k, v) in META_MAP.items()})
 
 FLAT = '♭'
 SHARP = '♯'
@@ -75,30 +78,43 @@ KEY_MAP = {
     (7, 1): 'A Sharp Minor',
 }
 
-REV_KEY_MAP = dict((v, k) for (k, v) in KEY_MAP.items())
 
+def _split_key_name(name):
+    # 'C Major' -> ('C', '', 'Major'); 'C Flat Major' -> ('C', 'Flat', 'Major')
+    parts = name.split()
+    accidental = parts[1] if len(parts) == 3 else ''
+    return (parts[0], accidental, parts[-1])
 
-def parse_key(key):
-    key = key.replace(' ', '').lower()
 
-    part1 = key[0].upper()
+REV_KEY_MAP = MappingProxyType({_split_key_name(v): k for (k, v) in KEY_MAP.items()})
 
-    if key[1:].startswith(FLAT) or key[1:].startswith('flat'):
-        part2 = 'Flat'
-    elif key[1:].startswith(SHARP) or key[1:].startswith('sharp'):
-        part2 = 'Sharp'
-    else:
-        part2 = ''
 
-    part3 = 'Major'
-    if key.endswith('minor'):
-        part3 = 'Minor'
-    elif key.endswith('major'):
-        part3 = 'Major'
-        
-    lookup_key = f'{part1} {part2} {part3}'
+ACCIDENTAL_SPELLINGS = {
+    '': ('',),
+    'Flat': ('flat', FLAT),
+    'Sharp': ('sharp', SHARP),
+}
+
+
+def _build_key_lookup():
+    # Map every accepted spelling of a key, lowercased and with whitespace
+    # removed, to its signature. A missing mode is taken to mean major.
+    lookup = {}
+    for (letter, accidental, mode), key_sig in REV_KEY_MAP.items():
+        letter = letter.lower()
+        mode = mode.lower()
+        modes = (mode, '') if mode == 'major' else (mode,)
+        for acc in ACCIDENTAL_SPELLINGS[accidental]:
+            for mode_str in modes:
+                lookup[f'{letter}{acc}{mode_str}'] = key_sig
+    return lookup
+
 
-    return REV_KEY_MAP.get(lookup_key)
+KEY_LOOKUP = MappingProxyType(_build_key_lookup())
+
+
+def parse_key(key):
+    return KEY_LOOKUP.get(key.replace(' ', '').lower())
 
 
 def fmt_timestamp(timestamp):
@@ -129,36 +145,66 @@ def fmt_timestamp(timestamp):
     #    to UT is considered to be unknown. Whether or not the time zone is
     #    known, the rest of the date should be specified in local time.
 
-    offset = timestamp.strftime('%z')
-    if offset:
-        offset_sign = offset[0]
-        offset_hr = offset[1:3] 
-        offset_min = offset[3:6]
-        fmt_offset = f"{offset_sign}{offset_hr}'{offset_min}'"
+    offset = timestamp.utcoffset()
+    if offset is not None:
+        offset_secs = int(offset.total_seconds())
+        offset_sign = '+' if offset_secs >= 0 else '-'
+        offset_hr, offset_min = divmod(abs(offset_secs) // 60, 60)
+        fmt_offset = f"{offset_sign}{offset_hr:02d}'{offset_min:02d}'"
     else:
         fmt_offset = ''
 
-    return timestamp.strftime(f"D:%Y%m%d%H%M%S{fmt_offset}")
-
-
+    return (f"D:{timestamp.year:04d}{timestamp.month:02d}{timestamp.day:02d}"
+            f"{timestamp.hour:02d}{timestamp.minute:02d}{timestamp.second:02d}"
+            f"{fmt_offset}")
+
+
+def _parse_fast(timestamp_str):
+    # Parse the full D:YYYYMMDDHHmmSS+HHmm form by position. Raises ValueError
+    # for anything else.
+    if len(timestamp_str) != 21 or not timestamp_str.startswith('D:'):
+        raise ValueError(f'Unexpected timestamp: {timestamp_str!r}')
+    offset_sign = timestamp_str[16]
+    if offset_sign not in '+-':
+        raise ValueError(f'Unexpected timestamp: {timestamp_str!r}')
+    # int() would also accept whitespace, signs and underscores, so require
+    # plain ASCII digits in every field.
+    digits = timestamp_str[2:16] + timestamp_str[17:21]
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f'Unexpected timestamp: {timestamp_str!r}')
+    offset = timedelta(hours=int(timestamp_str[17:19]),
+                       minutes=int(timestamp_str[19:21]))
+    if offset_sign == '-':
+        offset = -offset
+    return datetime(int(timestamp_str[2:6]), int(timestamp_str[6:8]),
+                    int(timestamp_str[8:10]), int(timestamp_str[10:12]),
+                    int(timestamp_str[12:14]), int(timestamp_str[14:16]),
+                    tzinfo=timezone(offset))
+
+
+@lru_cache(maxsize=256)
 def parse_timestamp_str(timestamp_str):
-    # Transform the offset so that strptime can parse it.
-    timestamp_str = RE_OFFSET.sub(r'\1\2\3', timestamp_str)
-    return datetime.strptime(timestamp_str, 'D:%Y%m%d%H%M%S%z')
+    # Transform the offset so that strptime can parse it. The offset has a
+    # fixed shape (+HH'mm'), so drop the quotes by position.
+    if len(timestamp_str) >= 7 and timestamp_str[-7] in '+-':
+        timestamp_str = timestamp_str[:-7] + timestamp_str[-7:-4] + timestamp_str[-3:-1]
+    try:
+        return _parse_fast(timestamp_str)
+    except ValueError:
+        # Fall back to strptime for other forms, such as a 'Z' offset
+        return datetime.strptime(timestamp_str, 'D:%Y%m%d%H%M%S%z')
 
 
 def dict_to_metadata(meta_dict):
-    for key, val in meta_dict.items():
-        if key == 'Key':
-            key_sig = parse_key(val)
-            yield ('/keysf', key_sig[0])
-            yield ('/keysmi', key_sig[1])
-        else:
-            meta_key = REV_META_MAP.get(key)
-            if meta_key:
-                yield (meta_key, val)
-            else:
-                print('Unknown Key:', key)
+    metadata = {REV_META_MAP[key]: val
+                for (key, val) in meta_dict.items() if key in REV_META_MAP}
+
+    # The key signature is split across two entries, replacing the
+    # placeholder mapping above.
+    if 'Key' in meta_dict:
+        metadata['/keysf'], metadata['/keysmi'] = parse_key(meta_dict['Key'])
+
+    return metadata
 
 
 def add_filename_prefix(filename, prefix):
@@ -173,17 +219,12 @@ def read_metadata(filename):
 
 def write_metadata(filename, metadata):
     filename_modified = add_filename_prefix(filename, 'modified-')
-    dst_pdf = PdfWriter()
     try:
-        src_pdf = PdfReader(filename)
+        # Only the document info changes, so clone the source wholesale rather
+        # than rebuilding it page by page. This preserves the existing metadata.
+        dst_pdf = PdfWriter(clone_from=filename)
     except EmptyFileError:
-        src_pdf = None
-    else:
-        for page in src_pdf.pages:
-            dst_pdf.add_page(page)
-
-        # Preserve the existing metadata
-        dst_pdf.add_metadata(src_pdf.metadata)
+        dst_pdf = PdfWriter()
 
     # Add the new metadata
     dst_pdf.add_metadata(metadata)
@@ -193,28 +234,82 @@ def write_metadata(filename, metadata):
         dst_pdf.write(f)
 
 
+def _process_row(pdf_dir, row):
+    filename, metadata = row
+    write_metadata(os.path.join(pdf_dir, filename), metadata)
+
+
 def update_pdfs(pdf_dir, csv_filename):
-    with open(csv_filename, newline='') as csvf:
-        data = csv.DictReader(csvf)
-        for row in data:
-            filename = row.pop('Filename')
-            file_path = os.path.join(pdf_dir, filename)
-            if os.path.isfile(file_path):
-                metadata = dict(dict_to_metadata(row))
-                write_metadata(file_path, metadata)
+    with open(csv_filename, newline='', buffering=CSV_READ_BUFFER_SIZE) as csvf:
+        reader = csv.reader(csvf)
+        headers = next(reader, None)
+        if headers is None:
+            # An empty CSV has nothing to update
+            return
+        fn_idx = headers.index('Filename')
+        meta_idxs = [(h, i) for (i, h) in enumerate(headers) if i != fn_idx]
+        # Report unknown columns once, rather than on every row
+        for key in sorted(set(headers) - REV_META_MAP.keys() - {'Filename'}):
+            print('Unknown Key:', key)
+        # Rows for the same file are merged, with later rows taking
+        # precedence, so each file is only rewritten once.
+        merged = {}
+        for row in reader:
+            if not row:
+                continue
+            filename = row[fn_idx]
+            # Blank cells carry no metadata
+            meta = {h: row[i] for (h, i) in meta_idxs if i < len(row) and row[i]}
+            metadata = dict_to_metadata(meta)
+            if not metadata:
+                # Nothing to change, so don't rewrite the file
+                continue
+            merged.setdefault(filename, {}).update(metadata)
+
+    # A single directory listing replaces a stat call per row. Names not in
+    # the listing are still checked on disk, which matches them on
+    # case-insensitive filesystems.
+    with os.scandir(pdf_dir) as entries:
+        existing = {entry.name for entry in entries if entry.is_file()}
+
+    # Different spellings of a name can refer to the same file on
+    # case-insensitive filesystems, so key each task on the file itself to
+    # keep two workers from writing the same output.
+    files = {}
+    for filename, metadata in merged.items():
+        file_path = os.path.join(pdf_dir, filename)
+        if filename in existing or os.path.isfile(file_path):
+            st = os.stat(file_path)
+            file_key = (st.st_dev, st.st_ino)
+            if file_key in files:
+                files[file_key][1].update(metadata)
             else:
-                print("File '{filename}' does not exist. Skipping.")
+                files[file_key] = (filename, metadata)
+        else:
+            print(f"File '{filename}' does not exist. Skipping.")
+
+    rows = list(files.values())
+
+    if not rows:
+        return
+
+    # Each file is read, parsed and rewritten independently, so spread the
+    # work across processes.
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(_process_row, repeat(pdf_dir), rows))
 
 def init_csv(pdf_dir, csv_filename):
     with open(csv_filename, newline='', mode='w') as csvf:
         headers = ['Filename', 'Title', 'Composer', 'Genre', 'Tags', 'Duration']
-        writer = csv.DictWriter(csvf, fieldnames=headers)
-        writer.writeheader()
-        template = dict((h, None) for h in headers)
-        for filepath in pathlib.Path(pdf_dir).glob('*.pdf'):
-            template['Filename'] = filepath.name
-            print(template)
-            writer.writerow(template)
+        writer = csv.writer(csvf)
+        writer.writerow(headers)
+        # Only the filename varies between rows
+        row = [None] * len(headers)
+        with os.scandir(pdf_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.pdf'):
+                    row[0] = entry.name
+                    writer.writerow(row)
 
 
 if __name__ == '__main__':
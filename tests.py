@@ -1,16 +1,22 @@
+import contextlib
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+import io
 import os
 import tempfile
 import unittest
 
+from pypdf import PdfWriter
+
 from pdf_updater import fmt_timestamp
+from pdf_updater import init_csv
 from pdf_updater import KEY_MAP
 from pdf_updater import parse_key
 from pdf_updater import parse_timestamp_str
 from pdf_updater import dict_to_metadata
 from pdf_updater import read_metadata
+from pdf_updater import update_pdfs
 from pdf_updater import write_metadata
 
 
@@ -35,6 +41,15 @@ class TestKeySignature(unittest.TestCase):
                 'b ♭    minor',
                 'b     ♭minor',
             ],
+            'C Major': [
+                'C Major',
+                'c   major',
+                'C',
+            ],
+            'A Minor': [
+                'A Minor',
+                'aminor',
+            ],
         }
 
         for expected_key, inputs in test_data.items():
@@ -53,6 +68,23 @@ class TestTimestamp(unittest.TestCase):
         expected_fmt = "D:20231217105600-05'00'"
         self.assertEqual(timestamp_str, expected_fmt)
 
+    def test_fmt_offsets(self):
+        tz = timezone(timedelta(hours=5, minutes=30))
+        timestamp = datetime(year=2023, month=1, day=2, hour=3, minute=4,
+                             second=5, tzinfo=tz)
+        self.assertEqual(fmt_timestamp(timestamp), "D:20230102030405+05'30'")
+
+        naive = timestamp.replace(tzinfo=None)
+        self.assertEqual(fmt_timestamp(naive), "D:20230102030405")
+
+    def test_fmt_same_instant(self):
+        # Equal instants in different timezones must keep their own offset
+        utc = datetime(year=2023, month=12, day=17, hour=15, minute=56,
+                       tzinfo=timezone.utc)
+        est = utc.astimezone(timezone(timedelta(hours=-5), 'EST'))
+        self.assertEqual(fmt_timestamp(utc), "D:20231217155600+00'00'")
+        self.assertEqual(fmt_timestamp(est), "D:20231217105600-05'00'")
+
     def test_parse(self):
         timestamp_str = "D:20231217105600-05'00'"
         timestamp = parse_timestamp_str(timestamp_str)
@@ -61,6 +93,20 @@ class TestTimestamp(unittest.TestCase):
         expected_timestamp = datetime(year=2023, month=12, day=17, hour=10,
                                       minute=56, tzinfo=tz)
         self.assertEqual(timestamp, expected_timestamp)
+        self.assertEqual(timestamp.utcoffset(), timedelta(hours=-5))
+
+    def test_parse_malformed(self):
+        for timestamp_str in ("D:2023121710560 +05'00'",
+                              "D:2023121710560_+05'00'",
+                              "D:202312171056+0+05'00'"):
+            with self.assertRaises(ValueError):
+                parse_timestamp_str(timestamp_str)
+
+    def test_parse_utc(self):
+        timestamp = parse_timestamp_str("D:20231217105600Z")
+        expected_timestamp = datetime(year=2023, month=12, day=17, hour=10,
+                                      minute=56, tzinfo=timezone.utc)
+        self.assertEqual(timestamp, expected_timestamp)
 
 
 class TestMetadataConvert(unittest.TestCase):
@@ -84,7 +130,18 @@ class TestMetadataConvert(unittest.TestCase):
             '/Keywords': 'awesome drum-solo distortion'
         }
 
-        output = dict(dict_to_metadata(metadata_input))
+        output = dict_to_metadata(metadata_input)
+        self.assertEqual(output, expected_output)
+        # Entries keep the input's column order
+        self.assertEqual(list(output), list(expected_output))
+
+    def test_transform_key(self):
+        output = dict_to_metadata({"Title": "Nocturne", "Key": "B Flat Minor"})
+        expected_output = {
+            '/Title': 'Nocturne',
+            '/keysf': -5,
+            '/keysmi': 1,
+        }
         self.assertEqual(output, expected_output)
 
 
@@ -92,12 +149,12 @@ class TestMetadataConvert(unittest.TestCase):
         tempf_orig = tempfile.NamedTemporaryFile()
         file_name1 = tempf_orig.name
         filename_modified = os.path.join(os.path.dirname(file_name1), 'modified-%s' % os.path.basename(file_name1))
-        metadata_in = dict(item for item in dict_to_metadata({
+        metadata_in = dict_to_metadata({
             "Composer": "Jeremy Nxxxxxxx",
             "Title": "Sacred Harp Metal Mash",
             "Genre": "Glam Rock",
             "Tags": "awesome drum-solo distortion",
-        }))
+        })
         write_metadata(file_name1, metadata_in)
         metadata_out = read_metadata(filename_modified)
         # PyPDF automatically adds itself as the producer
@@ -107,5 +164,106 @@ class TestMetadataConvert(unittest.TestCase):
         self.assertEqual(metadata_in, metadata_out) 
 
 
+class TestUpdatePdfs(unittest.TestCase):
+
+    def test_update(self):
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            for name in ('one.pdf', 'two.pdf', 'three.pdf'):
+                pdf = PdfWriter()
+                pdf.add_blank_page(width=72, height=72)
+                with open(os.path.join(pdf_dir, name), 'wb') as f:
+                    pdf.write(f)
+
+            csv_filename = os.path.join(pdf_dir, 'metadata.csv')
+            with open(csv_filename, 'w', newline='') as f:
+                f.write('Filename,Title,Composer\n')
+                f.write('one.pdf,First,Anonymous\n')
+                f.write('two.pdf,Second,\n')
+                f.write('three.pdf,,\n')
+                f.write('missing.pdf,Missing,Anonymous\n')
+                f.write('one.pdf,,Traditional\n')
+
+            update_pdfs(pdf_dir, csv_filename)
+
+            metadata = read_metadata(os.path.join(pdf_dir, 'modified-one.pdf'))
+            # Repeated rows are merged, later values winning
+            self.assertEqual(metadata['/Title'], 'First')
+            self.assertEqual(metadata['/Author'], 'Traditional')
+
+            # Blank cells are not written
+            metadata = read_metadata(os.path.join(pdf_dir, 'modified-two.pdf'))
+            self.assertEqual(metadata['/Title'], 'Second')
+            self.assertNotIn('/Author', metadata)
+
+            # Rows without metadata are skipped
+            self.assertFalse(os.path.exists(os.path.join(pdf_dir, 'modified-three.pdf')))
+            self.assertFalse(os.path.exists(os.path.join(pdf_dir, 'modified-missing.pdf')))
+
+    def test_same_file(self):
+        # Two names for one file, as on a case-insensitive filesystem, are
+        # written by a single task with the later row winning.
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            pdf = PdfWriter()
+            pdf.add_blank_page(width=72, height=72)
+            with open(os.path.join(pdf_dir, 'a.pdf'), 'wb') as f:
+                pdf.write(f)
+            os.link(os.path.join(pdf_dir, 'a.pdf'), os.path.join(pdf_dir, 'b.pdf'))
+
+            csv_filename = os.path.join(pdf_dir, 'metadata.csv')
+            with open(csv_filename, 'w', newline='') as f:
+                f.write('Filename,Title,Composer\n')
+                f.write('a.pdf,First,Anonymous\n')
+                f.write('b.pdf,Second,\n')
+
+            update_pdfs(pdf_dir, csv_filename)
+
+            metadata = read_metadata(os.path.join(pdf_dir, 'modified-a.pdf'))
+            self.assertEqual(metadata['/Title'], 'Second')
+            self.assertEqual(metadata['/Author'], 'Anonymous')
+            self.assertFalse(os.path.exists(os.path.join(pdf_dir, 'modified-b.pdf')))
+
+    def test_empty_csv(self):
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            csv_filename = os.path.join(pdf_dir, 'metadata.csv')
+            open(csv_filename, 'w').close()
+
+            update_pdfs(pdf_dir, csv_filename)
+
+            self.assertEqual(os.listdir(pdf_dir), ['metadata.csv'])
+
+    def test_unknown_keys(self):
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            csv_filename = os.path.join(pdf_dir, 'metadata.csv')
+            with open(csv_filename, 'w', newline='') as f:
+                f.write('Filename,Title,Colour\n')
+                f.write('one.pdf,First,Red\n')
+                f.write('two.pdf,Second,Blue\n')
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                update_pdfs(pdf_dir, csv_filename)
+
+            self.assertEqual(output.getvalue().count('Unknown Key: Colour'), 1)
+
+
+class TestInitCsv(unittest.TestCase):
+
+    def test_init(self):
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            for name in ('one.pdf', 'notes.txt'):
+                open(os.path.join(pdf_dir, name), 'w').close()
+            os.mkdir(os.path.join(pdf_dir, 'dir.pdf'))
+
+            csv_filename = os.path.join(pdf_dir, 'metadata.csv')
+            init_csv(pdf_dir, csv_filename)
+
+            with open(csv_filename, newline='') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines, [
+                'Filename,Title,Composer,Genre,Tags,Duration',
+                'one.pdf,,,,,',
+            ])
+
+
 if __name__ == '__main__':
     unittest.main()